@@ -1,10 +1,26 @@
 import os
+import sys
+import errno
 import argparse
 import random
-from typing import List, Optional, Union, Dict, Tuple, Set
-import json
+from typing import Iterable, List, Optional, Union, Dict, Tuple, Set
+import orjson
+import pickle
+import tempfile
+import hashlib
 from tqdm import tqdm
 import shutil
+import tarfile
+import io
+import time
+import contextlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Version of the format of the annotation cache files. Caches with a different version are ignored and regenerated
+ANNOTATIONS_CACHE_VERSION = 1
+# Line of a YOLOv8 label file: class ID, x center, y center, width and height
+YOLO_LABEL_LINE = '{} {} {} {} {}\n'
 
 
 class COCOConverter:
@@ -17,24 +33,31 @@ class COCOConverter:
         # Create output directories
         for dataset_type in ['train', 'valid', 'test']:
             os.makedirs(os.path.join(self.output_dir, dataset_type, 'images'), exist_ok=True)
-            os.makedirs(os.path.join(self.output_dir, dataset_type, 'labels'), exist_ok=True)
+            if self.label_format == 'loose':
+                os.makedirs(os.path.join(self.output_dir, dataset_type, 'labels'), exist_ok=True)
 
     def initialize_conversion(self) -> None:
         """Processes all sets of data and generates the new modified dataset"""
 
-        # Process each dataset
-        self.process_dataset('train',
-                             self.coco_annotation_train,
-                             self.coco_image_dir_train,
-                             self.single_class_name if self.create_single_class else None)
-        self.process_dataset('valid',
-                             self.coco_annotation_val,
-                             self.coco_image_dir_val,
-                             self.single_class_name if self.create_single_class else None)
-
-        self.process_dataset('test',
-                             self.coco_annotation_test,
-                             self.coco_image_dir_test)
+        datasets = [('train', self.coco_annotation_train, self.coco_image_dir_train, self.single_class_name if self.create_single_class else None),
+                    ('valid', self.coco_annotation_val, self.coco_image_dir_val, self.single_class_name if self.create_single_class else None),
+                    ('test', self.coco_annotation_test, self.coco_image_dir_test, None)]
+
+        # Process each dataset. The datasets are independent, so they can be processed at the same time in separate processes
+        if self.dataset_workers > 1:
+            # Share the image copy threads among the processes, so that max_concurrency remains the total number of threads
+            dataset_workers = min(self.dataset_workers, len(datasets))
+            self.max_concurrency = max(1, self.max_concurrency // dataset_workers)
+            with ProcessPoolExecutor(max_workers=dataset_workers) as executor:
+                futures = [executor.submit(self.process_dataset, *dataset) for dataset in datasets]
+                classes_info = [future.result() for future in futures]
+        else:
+            classes_info = [self.process_dataset(*dataset) for dataset in datasets]
+
+        # Keep the number of classes and class names of the last processed train/valid dataset for the data YAML file
+        for dataset_classes_info in classes_info:
+            if dataset_classes_info:
+                self.num_classes, self.class_names = dataset_classes_info
         
         if self.convert_to_yolo:
             self.create_data_yaml()
@@ -43,7 +66,7 @@ class COCOConverter:
                         dataset_type: str,
                         coco_annotation_file: str,
                         coco_image_dir: str,
-                        single_class_name: Optional[str] = None) -> None:
+                        single_class_name: Optional[str] = None) -> Optional[Tuple[int, List[str]]]:
         """
         Processes the new dataset in different ways, depending if the data is train/val or test.
         Args:
@@ -51,6 +74,8 @@ class COCOConverter:
             coco_annotation_file (str): Path to the annotations of the original COCO dataset.
             coco_image_dir (str): Path to the directory which contains the images of the original COCO dataset.
             single_class_name (Optional[str]): Name of the single class to be generated, if specified by the create_single_class parameter.
+        Returns:
+            Optional[Tuple[int, List[str]]]: Number of classes and class names of the new dataset, if train/val data was processed.
         """
 
         print(f'\nProcessing the {dataset_type} data...')
@@ -61,6 +86,7 @@ class COCOConverter:
         # If COCO annotations exist, process Train or Validation data
         elif os.path.exists(coco_annotation_file):
             self.process_train_val_data(dataset_type, coco_annotation_file, coco_image_dir, single_class_name)
+            return self.num_classes, self.class_names
 
         else:
             print(f'Could not find a COCO-format annotation file in {coco_annotation_file}')
@@ -84,29 +110,32 @@ class COCOConverter:
         if self.test_only_target_classes:
 
             if os.path.exists(self.coco_annotation_test):
-                with open(self.coco_annotation_test, 'r') as f:
-                    self.coco_data = json.load(f)
-                _, test_images_to_extract = self.extract_images_id_and_filenames(extract_target_images=True)
+                self.load_coco_data(self.coco_annotation_test)
+                _, test_images_to_extract = self.extract_images_id_and_filenames()
                 if self.test_num_images:
-                    test_images_to_extract = random.sample(test_images_to_extract, self.test_num_images)
+                    test_images_to_extract = self.reservoir_sample(test_images_to_extract, self.test_num_images)
 
             else:
                 print(f'Only test images with target classes must be extracted, but the annotation file for the test set was not found in {self.coco_annotation_test}')
 
         # If all test images can be extracted
         else:
-            test_images_to_extract = os.listdir(self.coco_image_dir_test) if not self.test_num_images else random.sample(os.listdir(self.coco_image_dir_test), self.test_num_images)
+            with os.scandir(self.coco_image_dir_test) as test_dir_entries:
+                test_filenames = (entry.name for entry in test_dir_entries)
+                test_images_to_extract = list(test_filenames) if not self.test_num_images else self.reservoir_sample(test_filenames, self.test_num_images)
 
         # Copy the selected test images to the new dataset's directory, and add the filename to the record
-        for filename in tqdm(test_images_to_extract):
+        images_to_copy = list()
+        for filename in test_images_to_extract:
             original_filename = os.path.join(self.coco_image_dir_test, filename)
-            new_filename = os.path.join(self.output_dir, 'test', 'images', filename)
-            shutil.copy(original_filename, new_filename)
+            new_filename = os.path.join(self.output_dir, 'test', 'images', os.path.basename(filename))
+            images_to_copy.append((original_filename, new_filename))
             images_record.append(new_filename)
+        self.copy_images(images_to_copy)
             
         # Save YOLOv8 or COCO format record of images filenames
         with open(os.path.join(self.output_dir, f'{dataset_type}.txt'), 'w') as dataset_list:
-            dataset_list.write('\n'.join(images_record))
+            dataset_list.writelines(image_path + '\n' for image_path in images_record)
 
         print(f'{dataset_type.capitalize()} images successfully stored in {os.path.join(self.output_dir, f"{dataset_type}.txt")}. Total images: {len(images_record)}')
 
@@ -130,9 +159,8 @@ class COCOConverter:
             single_class_name (Optional[str]): Name of the single class to be generated, if specified by the create_single_class parameter.
         """
 
-        with open(coco_annotation_file, 'r') as f:
-            self.coco_data = json.load(f)
-        print(f'Number of images present in {dataset_type} data: {len([image_info["id"] for image_info in self.coco_data["images"]])}')
+        self.load_coco_data(coco_annotation_file)
+        print(f'Number of images present in {dataset_type} data: {len(self.image_info_by_id)}')
 
         # Create a new category for the single class if required
         if single_class_name:
@@ -143,15 +171,15 @@ class COCOConverter:
 
         # Get unique image IDs with/out target classes if required
         unique_images_with_target_classes, unique_images_without_target_classes = set(), set()
-        if self.target_classes:
+        if self.target_classes and self.background_percentage > 0.0:
+            print(f'Extracting image IDs for images containing {self.target_classes} classes, and for background images not containing them')
+            unique_images_with_target_classes, unique_images_without_target_classes = self.partition_image_ids()
+            print('Image ID extraction completed successfully')
+
+        elif self.target_classes:
             print(f'Extracting image IDs for images containing {self.target_classes} classes')
-            unique_images_with_target_classes, _ = self.extract_images_id_and_filenames(extract_target_images=True)
+            unique_images_with_target_classes, _ = self.extract_images_id_and_filenames()
             print('Image ID extraction completed successfully')
-            if self.background_percentage > 0.0:
-                print(f'Extracting image IDs for background images not containing {self.target_classes} classes')
-                unique_images_without_target_classes, _ = self.extract_images_id_and_filenames(extract_target_images=False,
-                                                                              num_img_with_target_classes=len(unique_images_with_target_classes))
-                print('Background image ID extraction completed successfully')
 
         else:
             print(f'Extracting image IDs for all images')
@@ -159,32 +187,36 @@ class COCOConverter:
             print('Image ID extraction completed successfully')
 
 
-        # Initialize record lists
+        # Initialize record lists and, if required, the archive where all the label files will be stored
         images_record, labels_record = list(), list()
-        # Iterate through unique images with target classes
-        if self.target_classes: print(f'Converting annotations that contain the target classes in {dataset_type} data...')
-        else: print(f'Converting annotations for all images in {dataset_type} data...')
-        self.convert_and_save_annotations_and_img(unique_images=unique_images_with_target_classes,
-                                                  coco_image_dir=coco_image_dir,
-                                                  dataset_type=dataset_type,
-                                                  images_record=images_record,
-                                                  labels_record=labels_record,
-                                                  is_background=False)
-            
-        if unique_images_without_target_classes: 
-            print(f'Converting annotations that do not have the target classes in {dataset_type} data... (Number of background images is {self.background_percentage}% of the images that contain target classes)')
-            # Iterate through unique images without target classes
-            self.convert_and_save_annotations_and_img(unique_images=unique_images_without_target_classes,
+        labels_tar_path = os.path.join(self.output_dir, dataset_type, ('labels' if self.convert_to_yolo else 'annotations') + '.tar')
+        with tarfile.open(labels_tar_path, 'w') if self.label_format == 'tar' else contextlib.nullcontext() as labels_tar:
+            # Iterate through unique images with target classes
+            if self.target_classes: print(f'Converting annotations that contain the target classes in {dataset_type} data...')
+            else: print(f'Converting annotations for all images in {dataset_type} data...')
+            self.convert_and_save_annotations_and_img(unique_images=unique_images_with_target_classes,
                                                       coco_image_dir=coco_image_dir,
                                                       dataset_type=dataset_type,
                                                       images_record=images_record,
                                                       labels_record=labels_record,
-                                                      is_background=True)
+                                                      labels_tar=labels_tar,
+                                                      is_background=False)
+
+            if unique_images_without_target_classes: 
+                print(f'Converting annotations that do not have the target classes in {dataset_type} data... (Number of background images is {self.background_percentage * 100}% of the images that contain target classes)')
+                # Iterate through unique images without target classes
+                self.convert_and_save_annotations_and_img(unique_images=unique_images_without_target_classes,
+                                                          coco_image_dir=coco_image_dir,
+                                                          dataset_type=dataset_type,
+                                                          images_record=images_record,
+                                                          labels_record=labels_record,
+                                                          labels_tar=labels_tar,
+                                                          is_background=True)
         print(f'Annotations successfully converted for {dataset_type} data')
             
         # Save YOLOv8 or COCO format lists
         with open(os.path.join(self.output_dir, f'{dataset_type}.txt'), 'w') as dataset_list:
-            dataset_list.write('\n'.join(images_record))
+            dataset_list.writelines(image_path + '\n' for image_path in images_record)
 
         print(f'{dataset_type.capitalize()} images record successfully stored in {os.path.join(self.output_dir, f"{dataset_type}.txt")}. Total images: {len(images_record)}')
 
@@ -195,6 +227,7 @@ class COCOConverter:
                                              dataset_type: str,
                                              images_record: List[str],
                                              labels_record: List[str],
+                                             labels_tar: Optional[tarfile.TarFile],
                                              is_background: bool) -> None:
         """
         Iterates through the previously selected images (whose IDs are stored in unique_images parameter) and converts 
@@ -206,43 +239,168 @@ class COCOConverter:
             dataset_type (str): train/valid/test
             images_record (List[str]): List which records all the new dataset's images' filenames.
             labels_record (List[str]): List which records all the new dataset's labels' filenames.
+            labels_tar (Optional[tarfile.TarFile]): Archive where the label files are stored, if label_format is tar.
+                If None, every label file is written to the labels directory. Labels stored in the archive are recorded 
+                as <archive path>:<member name>.
             is_background (bool): Boolean indicating whether the set of images IDs correspond to images containing 
                 the target objects or just background.
         """
 
+        # Compute the output directories once
+        to_yolo = self.convert_to_yolo
+        convert_annotations_to_yolo = self.convert_annotations_from_coco_to_yolo_single_class if self.create_single_class \
+            else self.convert_annotations_from_coco_to_yolo
+        label_extension = '.txt' if to_yolo else '.json'
+        images_record_dir = os.path.join(dataset_type, 'images')
+        images_out_dir = os.path.join(self.output_dir, images_record_dir)
+        labels_out_dir = os.path.join(self.output_dir, dataset_type, 'labels' if to_yolo else 'annotations')
+        created_label_dirs = set()
+        label_mtime = int(time.time())
+
         # Iterate through unique images with target classes
+        images_to_copy = list()
         for img_id in tqdm(unique_images):
-            img_info: Dict[str, Union[str, int]] = next((img for img in self.coco_data.get('images', []) if img['id'] == img_id), None)
+            img_info: Dict[str, Union[str, int]] = self.image_info_by_id.get(img_id)
                 
             if img_info:
 
-                # Copy image to the new directory
-                img_path = os.path.join(coco_image_dir, img_info['file_name'])
-                shutil.copy(img_path, os.path.join(self.output_dir, dataset_type, 'images'))
-                images_record.append(os.path.join(dataset_type, 'images', img_info['file_name'])) # Record image filename
+                # Schedule the copy of the image to the new directory (images are stored directly in it, without subdirectories)
+                img_filename = img_info['file_name']
+                new_img_filename = os.path.basename(img_filename)
+                images_to_copy.append((os.path.join(coco_image_dir, img_filename), os.path.join(images_out_dir, new_img_filename)))
+                images_record.append(os.path.join(images_record_dir, new_img_filename)) # Record image filename
 
                 if is_background:
                     # If it is a background image, no target class is present
-                    label_content = ''
+                    label_content = b'' if to_yolo else orjson.dumps({'annotations': []})
 
                 else:
                     # Convert annotations to YOLOv8 or COCO format
-                    annotations = [ann for ann in self.coco_data.get('annotations', []) if ann['image_id'] == img_id]
-                    if self.convert_to_yolo:
-                        label_content = self.convert_annotations_from_coco_to_yolo(img_info=img_info, annotations=annotations)
+                    annotations = self.annotations_by_image_id.get(img_id, ())
+                    if to_yolo:
+                        label_content = convert_annotations_to_yolo(img_info=img_info, annotations=annotations).encode()
                     else:
-                        # TODO: Add logic for COCO-COCO conversions
-                        pass
+                        # Keep the original COCO annotations, only for the target classes if any
+                        if self.target_classes:
+                            annotations = [ann for ann in annotations if ann['category_id'] in self.yolo_class_by_category_id]
+                        label_content = orjson.dumps({'annotations': annotations})
 
                 # Save YOLOv8 or COCO format label file
-                label_filename = os.path.splitext(img_info['file_name'])[0] + ('.txt' if self.convert_to_yolo else '.json')
-                label_filepath = os.path.join(self.output_dir, dataset_type, 'labels' if self.convert_to_yolo else 'annotations', label_filename)
-                os.makedirs(os.path.dirname(label_filepath), exist_ok=True) # Ensure the directory exists before writing the label file
-                with open(label_filepath, 'w') as label_file:
-                    label_file.write(label_content)
+                label_filename = os.path.splitext(img_filename)[0] + label_extension
+                if labels_tar:
+                    label_tar_info = tarfile.TarInfo(label_filename)
+                    label_tar_info.size = len(label_content)
+                    label_tar_info.mtime = label_mtime
+                    labels_tar.addfile(label_tar_info, io.BytesIO(label_content))
+                    label_filepath = f'{labels_out_dir}.tar:{label_filename}' # Archive member of the label file
+                else:
+                    label_filepath = os.path.join(labels_out_dir, label_filename)
+                    # Ensure the directory exists before writing the label file (image filenames may include subdirectories)
+                    label_dir = os.path.dirname(label_filepath)
+                    if label_dir not in created_label_dirs:
+                        os.makedirs(label_dir, exist_ok=True)
+                        created_label_dirs.add(label_dir)
+                    with open(label_filepath, 'wb') as label_file:
+                        label_file.write(label_content)
                     
                 # Record label filename
                 labels_record.append(label_filepath)
+
+        # Copy the selected images to the new directory
+        self.copy_images(images_to_copy)
+
+    def copy_images(self, images_to_copy: List[Tuple[str, str]]) -> None:
+        """
+        Copies the images to the new dataset's directory. The copies are independent from each other, so they are 
+        distributed among max_concurrency threads.
+        Args:
+            images_to_copy (List[Tuple[str, str]]): List of (source path, destination path) tuples, one per image.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            list(tqdm(executor.map(lambda paths: self.transfer_image(*paths), images_to_copy), total=len(images_to_copy)))
+
+    def transfer_image(self, image_path: str, new_image_path: str) -> None:
+        """
+        Copies a single image to the new dataset's directory, according to the link_mode parameter:
+            - copy: the image data is copied.
+            - hardlink: a hard link to the original image is created, so no data is copied. Both paths refer to the same file.
+            - reflink: the data is copied with copy_file_range, which lets the filesystem share the data blocks between 
+              both files (copy-on-write) if it supports it.
+        If the image cannot be linked (e.g. the new dataset is on a different filesystem), it is copied instead.
+        Args:
+            image_path (str): Path to the image in the original dataset.
+            new_image_path (str): Path to the image in the new dataset.
+        """
+        # Remove any previous version of the new image, which could be a hard link to the original image that must not be overwritten
+        try:
+            os.remove(new_image_path)
+        except FileNotFoundError:
+            pass
+
+        try:
+            if self.link_mode == 'hardlink':
+                os.link(image_path, new_image_path)
+                return
+
+            if self.link_mode == 'reflink':
+                with open(image_path, 'rb') as image_file, open(new_image_path, 'wb') as new_image_file:
+                    remaining = os.fstat(image_file.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(image_file.fileno(), new_image_file.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                if remaining <= 0:
+                    return
+
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                raise
+
+        self.copy_file(image_path, new_image_path)
+
+    @staticmethod
+    def copy_file(file_path: str, new_file_path: str) -> None:
+        """
+        Copies the data of a file. On Linux, the data is copied inside the kernel with sendfile, without going through 
+        user space, and the kernel is told that the file will be read sequentially. If the filesystem does not support 
+        sendfile (e.g. some FUSE or network mounts), the data is copied through user space. On other platforms, 
+        shutil.copyfile is used.
+        Args:
+            file_path (str): Path to the file to be copied.
+            new_file_path (str): Path to the copy of the file.
+        """
+        if not sys.platform.startswith('linux'):
+            shutil.copyfile(file_path, new_file_path)
+            return
+
+        src_fd = os.open(file_path, os.O_RDONLY)
+        try:
+            dst_fd = os.open(new_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                try:
+                    os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    # The hint is only an optimization
+                    pass
+                size = os.fstat(src_fd).st_size
+                sent = 0
+                try:
+                    while sent < size:
+                        copied = os.sendfile(dst_fd, src_fd, sent, size - sent)
+                        if copied == 0:
+                            break
+                        sent += copied
+                except OSError as e:
+                    if sent > 0 or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP):
+                        raise
+                    # sendfile is not supported for these files, nothing was copied yet: copy the data through user space
+                    with open(src_fd, 'rb', closefd=False) as src_file, open(dst_fd, 'wb', closefd=False) as dst_file:
+                        shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
     
     def convert_annotations_from_coco_to_yolo(self, 
                                               img_info: Dict[str, Union[int, str]],
@@ -277,78 +435,222 @@ class COCOConverter:
             str: Label (annotation) content in YOLOv8 format.
         """
 
-        label_content = ""
+        yolo_class_by_category_id = self.yolo_class_by_category_id
+        img_width, img_height = img_info['width'], img_info['height']
+        format_label_line = YOLO_LABEL_LINE.format
+        label_lines = list()
 
         # Iterate through each annotation
         for ann in annotations:
+            # If the category of the annotation is a target one, include the annotation in YOLOv8 format
             category_id = ann['category_id']
-            category_name = next((cat['name'] for cat in self.coco_data.get('categories', []) if cat['id'] == category_id), None)
-            
+            if category_id in yolo_class_by_category_id:
+                # COCO format: (x, y, width, height). Normalize values to be between 0 and 1
+                x, y, width, height = ann['bbox']
+                label_lines.append(format_label_line(yolo_class_by_category_id[category_id],
+                                                     (x + width / 2) / img_width, (y + height / 2) / img_height,
+                                                     width / img_width, height / img_height))
+
+        return ''.join(label_lines)
+
+    def convert_annotations_from_coco_to_yolo_single_class(self,
+                                                           img_info: Dict[str, Union[int, str]],
+                                                           annotations: List[Dict[str, Union[List[List[float]], float, int, List[float]]]]) -> str:
+        """
+        Converts the received image's original annotations in COCO format to the YOLOv8 format, when all the target classes 
+        are joined into a single class. Same as convert_annotations_from_coco_to_yolo, but every annotation of a target 
+        class gets the class ID 0, so the class ID of each annotation does not need to be looked up.
+        Args:
+            img_info (Dict[str, Union[int, str]]): Image info extracted from the original dataset's data.
+            annotations (List[Dict[str, Union[List[List[float]], float, int, List[float]]]]): List of annotations for the image.
+        Returns:
+            str: Label (annotation) content in YOLOv8 format.
+        """
+
+        target_category_ids = self.yolo_class_by_category_id.keys()
+        img_width, img_height = img_info['width'], img_info['height']
+        format_label_line = YOLO_LABEL_LINE.format
+        label_lines = list()
+
+        # Iterate through each annotation
+        for ann in annotations:
             # If the category of the annotation is a target one, include the annotation in YOLOv8 format
-            if category_name in self.target_classes:
-                category_id = self.target_classes.index(category_name) if not self.create_single_class else 0
-                # COCO format: (x, y, width, height)
-                bbox = ann['bbox']
-                x_center = bbox[0] + bbox[2] / 2
-                y_center = bbox[1] + bbox[3] / 2
-                width = bbox[2]
-                height = bbox[3]
-
-                # Normalize values to be between 0 and 1
-                x_center /= img_info['width']
-                y_center /= img_info['height']
-                width /= img_info['width']
-                height /= img_info['height']
-
-                label_content += f"{category_id} {x_center} {y_center} {width} {height}\n"
-
-        return label_content
+            if ann['category_id'] in target_category_ids:
+                # COCO format: (x, y, width, height). Normalize values to be between 0 and 1
+                x, y, width, height = ann['bbox']
+                label_lines.append(format_label_line(0,
+                                                     (x + width / 2) / img_width, (y + height / 2) / img_height,
+                                                     width / img_width, height / img_height))
+
+        return ''.join(label_lines)
     
-    def extract_images_id_and_filenames(self,
-                                        extract_target_images: bool = True,
-                                        num_img_with_target_classes: Optional[int] = None,
-                                        extract_all: bool = False) -> Tuple[Set[int]]:
+    def extract_images_id_and_filenames(self, extract_all: bool = False) -> Tuple[Set[int], Set[str]]:
         """
         Extracts the image IDs and filenames of those images who must be extracted to the new dataset.
         Args:
-            extract_target_images (bool): If set to True, only the IDs and filenames of images that contain the target images will be extracted.
-                                          If set to False, only the IDs and filenames of images that do not contain the target images will be extracted.
-            num_img_with_target_classes (Optional[int]): This parameter represents the number of unique images containing the target 
-                classes that currently are in the new dataset. It is used to calculate the number of background images that must be 
-                extracted as a percentage of the current number of target class images.
-            extract_all (bool): If set to True, all image IDs and filenames are extracted.
+            extract_all (bool): If set to True, all image IDs and filenames are extracted. Otherwise, only the IDs and 
+                filenames of images that contain the target classes are extracted.
         Returns:
-            Tuple[Set[int]]: Tuple containing the sets of the IDs anf filenames of the images that must be moved and converted to 
-                the new dataset, according to the user's configuration. 
+            Tuple[Set[int], Set[str]]: Tuple containing the sets of the IDs and filenames of the images that must be moved 
+                and converted to the new dataset, according to the user's configuration. 
         """
 
-        unique_images_id, unique_images_filenames = set(), set()
-
         if extract_all:
-            return set([image_info['id'] for image_info in self.coco_data['images']]), \
-                   set([image_info['file_name'] for image_info in self.coco_data['images']])
+            unique_images_id = set(self.image_info_by_id)
 
-        # Iterate through annotations to search for target/non-target images
-        for ann in tqdm(self.coco_data.get('annotations', [])):
-            category_id = ann['category_id']
-            category_name = next((cat['name'] for cat in self.coco_data.get('categories', []) if cat['id'] == category_id), None)
-            
-            # Check if the annotation is for any target class
-            if (category_name in self.target_classes) == extract_target_images:
-                image_id = ann['image_id']
+        else:
+            # Search for the annotated images which contain any target class
+            target_category_ids = self.yolo_class_by_category_id.keys()
+            unique_images_id = {image_id for image_id, category_ids in tqdm(self.category_ids_by_image_id.items())
+                                if not target_category_ids.isdisjoint(category_ids)}
+
+        return unique_images_id, {self.image_info_by_id[image_id]['file_name'] for image_id in unique_images_id}
+
+    def partition_image_ids(self) -> Tuple[Set[int], Set[int]]:
+        """
+        Splits the annotated images in a single pass into images that contain any target class and background images, 
+        which do not contain any of them. Only a random subset of the background images is kept, whose size is 
+        background_percentage times the number of images containing target classes.
+        Returns:
+            Tuple[Set[int], Set[int]]: Tuple containing the sets of the IDs of the images with target classes and of the 
+                selected background images.
+        """
 
-                # Add ID to set
-                unique_images_id.add(image_id)
-                # Add filename to set
-                result_dict = next((img_data for img_data in self.coco_data['images'] if img_data['id'] == image_id), None)
-                unique_images_filenames.add(result_dict['file_name'])
+        unique_images_with_target_classes, unique_images_without_target_classes = set(), set()
+
+        # Iterate through the annotated images to search for target/non-target images
+        target_category_ids = self.yolo_class_by_category_id.keys()
+        for image_id, category_ids in tqdm(self.category_ids_by_image_id.items()):
+            if target_category_ids.isdisjoint(category_ids):
+                unique_images_without_target_classes.add(image_id)
+            else:
+                unique_images_with_target_classes.add(image_id)
 
-                if not extract_target_images:
-                    if len(unique_images_id) > num_img_with_target_classes * self.background_percentage:
-                        break
+        # Sample the required number of background images
+        num_background_images = min(int(len(unique_images_with_target_classes) * self.background_percentage),
+                                    len(unique_images_without_target_classes))
+        unique_images_without_target_classes = set(random.sample(list(unique_images_without_target_classes), num_background_images))
 
-        return unique_images_id, unique_images_filenames
+        return unique_images_with_target_classes, unique_images_without_target_classes
     
+    def load_coco_data(self, coco_annotation_file: str) -> None:
+        """
+        Loads the original COCO annotation file and builds the lookup tables used during the conversion.
+        If cache_annotations is set, the parsed data and lookup tables are cached in a pickle file in the user's cache 
+        directory, which is reused on later runs as long as the annotation file is not modified.
+        Args:
+            coco_annotation_file (str): Path to the annotations of the original COCO dataset.
+        """
+        cache_path = self.get_annotations_cache_path(coco_annotation_file) if self.cache_annotations else None
+        if not (cache_path and os.path.exists(cache_path) and self.load_annotations_cache(cache_path)):
+            with open(coco_annotation_file, 'rb') as f:
+                self.coco_data = orjson.loads(f.read())
+            self.index_coco_data()
+            if self.cache_annotations:
+                self.save_annotations_cache(cache_path)
+
+        self.map_target_categories()
+
+    @staticmethod
+    def get_annotations_cache_path(coco_annotation_file: str) -> str:
+        """
+        Gets the path to the annotation cache file of an annotation file. Caches are stored in the user's cache directory 
+        ($XDG_CACHE_HOME or ~/.cache), never next to the input data, and are named after the absolute path, size and 
+        modification time of the annotation file, so a modified annotation file never matches an old cache.
+        Args:
+            coco_annotation_file (str): Path to the annotations of the original COCO dataset.
+        Returns:
+            str: Path to the annotation cache file.
+        """
+        annotation_path = os.path.abspath(coco_annotation_file)
+        annotation_stat = os.stat(annotation_path)
+        cache_key = hashlib.sha256(f'{annotation_path}\0{annotation_stat.st_size}\0{annotation_stat.st_mtime_ns}'.encode()).hexdigest()
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'coco_dataset_extractor')
+        return os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(annotation_path))[0]}-{cache_key[:32]}.pkl')
+
+    def load_annotations_cache(self, cache_path: str) -> bool:
+        """
+        Loads the parsed COCO data and lookup tables from an annotation cache file.
+        Args:
+            cache_path (str): Path to the annotation cache file.
+        Returns:
+            bool: True if the cache was loaded, False if it is corrupted or was written with a different format version.
+        """
+        try:
+            with open(cache_path, 'rb') as f:
+                cache_version, cached_data = pickle.load(f)
+            if cache_version != ANNOTATIONS_CACHE_VERSION:
+                raise ValueError(f'cache version {cache_version} does not match the current version {ANNOTATIONS_CACHE_VERSION}')
+            (self.coco_data, self.category_name_by_id, self.image_info_by_id,
+             self.annotations_by_image_id, self.category_ids_by_image_id) = cached_data
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError) as e:
+            print(f'Ignoring the annotation cache {cache_path}, it will be regenerated: {e}')
+            return False
+        return True
+
+    def save_annotations_cache(self, cache_path: str) -> None:
+        """
+        Saves the parsed COCO data and lookup tables in an annotation cache file. The cache is written to a temporary file 
+        which then replaces the cache file, so an interrupted or failed write never leaves a partial cache behind.
+        Args:
+            cache_path (str): Path to the annotation cache file.
+        """
+        try:
+            os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+            fd, tmp_cache_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.', prefix=os.path.basename(cache_path), suffix='.tmp')
+        except OSError as e:
+            print(f'Could not write the annotation cache {cache_path}: {e}')
+            return
+
+        try:
+            # mkstemp creates the file with mode 0600: apply the user's umask instead, as for any other new file
+            umask = os.umask(0)
+            os.umask(umask)
+            os.fchmod(fd, 0o666 & ~umask)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((ANNOTATIONS_CACHE_VERSION,
+                             (self.coco_data, self.category_name_by_id, self.image_info_by_id,
+                              self.annotations_by_image_id, self.category_ids_by_image_id)),
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_cache_path, cache_path)
+        except BaseException as e:
+            # Remove the partial cache, and only keep going if the error comes from the filesystem (e.g. disk full)
+            try:
+                os.remove(tmp_cache_path)
+            except OSError:
+                pass
+            if not isinstance(e, OSError):
+                raise
+            print(f'Could not write the annotation cache {cache_path}: {e}')
+
+    def index_coco_data(self) -> None:
+        """
+        Builds the lookup tables used during the conversion from the loaded COCO data, so that categories, images and 
+        annotations can be retrieved by ID without scanning the whole annotation file every time:
+            - category_name_by_id: category ID -> category name.
+            - image_info_by_id: image ID -> image info.
+            - annotations_by_image_id: image ID -> list of annotations of that image.
+            - category_ids_by_image_id: image ID -> set of category IDs annotated in that image.
+        """
+        self.category_name_by_id: Dict[int, str] = {cat['id']: cat['name'] for cat in self.coco_data.get('categories', [])}
+        self.image_info_by_id: Dict[int, Dict[str, Union[str, int]]] = {img['id']: img for img in self.coco_data.get('images', [])}
+        annotations_by_image_id = defaultdict(list)
+        for ann in self.coco_data.get('annotations', []):
+            annotations_by_image_id[ann['image_id']].append(ann)
+        self.annotations_by_image_id: Dict[int, List[Dict]] = dict(annotations_by_image_id)
+        self.category_ids_by_image_id: Dict[int, Set[int]] = {
+            image_id: {ann['category_id'] for ann in annotations}
+            for image_id, annotations in self.annotations_by_image_id.items()
+        }
+
+    def map_target_categories(self) -> None:
+        """Maps the category ID of every target class to the class ID it will have in the new dataset"""
+        self.yolo_class_by_category_id: Dict[int, int] = {
+            category_id: 0 if self.create_single_class else self.target_class_index_by_name[category_name]
+            for category_id, category_name in self.category_name_by_id.items()
+            if category_name in self.target_class_index_by_name
+        }
+
     def create_new_class(self) -> None:
         """Creates a new class in the original annotations file"""
         # Create a new category for the single class
@@ -361,6 +663,7 @@ class COCOConverter:
                 'supercategory': self.single_class_name,
             }
             self.coco_data.setdefault('categories', []).append(new_category)
+            self.category_name_by_id[new_category_id] = self.single_class_name
 
     def create_data_yaml(self):
         """Creates the data YAML file required to run a training on the YOLOv8 arquitecture with ultralytics"""
@@ -387,12 +690,22 @@ class COCOConverter:
         parser.add_argument('--target_classes', '--names-list', nargs='+', default=[], help='Array of strings,where each string is the name of the '
                                                                                             'class whose images that must be extracted from the original COCO dataset.')
         parser.add_argument('--background_percentage', type=float, default=0.0, help='Only applies if some classes are being extracted from COCO dataset. '
-                            'The new dataset will include <background_percentage>% more images, which will not contain any of the target classes.')
+                            'The new dataset will include <background_percentage> * 100% more images (e.g. 0.2 adds 20% more images), which will not contain any of the target classes.')
         parser.add_argument('--test_num_images', type=int, help='Number of test images from the original COCO dataset to include in the new dataset.')
-        parser.add_argument('--test_only_target_classes', type=bool, default=False, help='Boolean indicating whether to include only images with the target classes or any image.')
-        parser.add_argument('--create_single_class', type=bool, default=False, help='Boolean indicating whether to join all the selected classes into a single class. Defaults to True.')
+        parser.add_argument('--test_only_target_classes', action=argparse.BooleanOptionalAction, default=False, help='Whether to include only test images with the target classes or any image.')
+        parser.add_argument('--create_single_class', action=argparse.BooleanOptionalAction, default=False, help='Whether to join all the selected classes into a single class.')
         parser.add_argument('--single_class_name', type=str, default='new_class', help='Only applies if create_single_class param is set to True. Name of the single class to be generated.')
-        parser.add_argument('--convert_to_yolo', type=bool, default=True, help='Boolean indicating whether to convert the annotations to YOLOv8 or not.')
+        parser.add_argument('--convert_to_yolo', action=argparse.BooleanOptionalAction, default=True, help='Whether to convert the annotations to YOLOv8 or not.')
+        parser.add_argument('--label_format', type=str, choices=['loose', 'tar'], default='loose', help='Whether to write one label file per image (loose) or '
+                            'to store all the label files of each set in a single tar archive (tar).')
+        parser.add_argument('--link_mode', type=str, choices=['copy', 'hardlink', 'reflink'], default='copy', help='How to transfer the images to the new dataset: '
+                            'copy them, hard link them (edits to the new images also modify the original ones) or reflink them (copy-on-write, on supporting filesystems). '
+                            'Falls back to copy if the images cannot be linked.')
+        parser.add_argument('--cache_annotations', action=argparse.BooleanOptionalAction, default=True, help='Whether to cache the parsed annotations '
+                            'in the user cache directory ($XDG_CACHE_HOME or ~/.cache), which makes later executions load them faster.')
+        parser.add_argument('--dataset_workers', type=int, default=1, help='Number of sets (train/valid/test) processed at the same time in separate processes. '
+                            'Values above 1 multiply the peak memory usage and interleave the progress output of the sets. Defaults to 1.')
+        parser.add_argument('--max_concurrency', type=int, default=(os.cpu_count() or 1) * 2, help='Total number of threads used to copy the images to the new dataset. Defaults to twice the number of CPUs.')
 
         # Parse the command line arguments
         args = parser.parse_args()
@@ -407,6 +720,11 @@ class COCOConverter:
         print(f"Create Single Class: {args.create_single_class}")
         print(f"Single Class Name: {args.single_class_name}")
         print(f"Convert to YOLO: {args.convert_to_yolo}")
+        print(f"Label Format: {args.label_format}")
+        print(f"Link Mode: {args.link_mode}")
+        print(f"Cache Annotations: {args.cache_annotations}")
+        print(f"Dataset Workers: {args.dataset_workers}")
+        print(f"Max Concurrency: {args.max_concurrency}")
 
         self.coco_annotation_train = os.path.join(args.dataset_dir, 'annotations', 'instances_train.json')
         self.coco_image_dir_train = os.path.join(args.dataset_dir, 'images', 'train')
@@ -416,12 +734,21 @@ class COCOConverter:
         self.coco_image_dir_test = os.path.join(args.dataset_dir, 'images', 'test')
         self.output_dir = args.output_dir
         self.target_classes = args.target_classes
+        self.target_class_index_by_name = {class_name: self.target_classes.index(class_name) for class_name in self.target_classes}
         self.background_percentage = args.background_percentage
         self.test_num_images = args.test_num_images
         self.test_only_target_classes = args.test_only_target_classes
         self.create_single_class = args.create_single_class
         self.single_class_name = args.single_class_name
         self.convert_to_yolo = args.convert_to_yolo
+        self.label_format = args.label_format
+        self.link_mode = args.link_mode
+        if self.link_mode == 'reflink' and not hasattr(os, 'copy_file_range'):
+            print('Reflinks are not supported on this platform (os.copy_file_range is not available), images will be copied instead')
+            self.link_mode = 'copy'
+        self.cache_annotations = args.cache_annotations
+        self.dataset_workers = args.dataset_workers
+        self.max_concurrency = args.max_concurrency
 
     def set_classes_num_and_name(self) -> None:
         """Sets the number of classes and the names of the classes on the new dataset"""
@@ -435,6 +762,27 @@ class COCOConverter:
             self.num_classes = len(self.coco_data.get('categories', []))
             self.class_names = [category_info.get('name') for category_info in self.coco_data.get('categories', [])]
     
+    @staticmethod
+    def reservoir_sample(population: Iterable, k: int) -> list:
+        """
+        Randomly samples k elements from the population in a single pass (reservoir sampling), without building a list 
+        of the whole population first. If the population has less than k elements, all of them are returned.
+        Args:
+            population (Iterable): Iterable of elements to sample from.
+            k (int): Number of elements to sample.
+        Returns:
+            list: List of the sampled elements.
+        """
+        sample = list()
+        for i, element in enumerate(population):
+            if i < k:
+                sample.append(element)
+            else:
+                j = random.randrange(i + 1)
+                if j < k:
+                    sample[j] = element
+        return sample
+
     @staticmethod
     def serialize(obj):
         if isinstance(obj, (set,)):